@@ -8,7 +8,6 @@ It takes care of activating a new NuvlaBox
 
 import json
 import logging
-import docker
 import requests
 
 from agent.common import NuvlaBoxCommon
@@ -31,6 +30,9 @@ class Activate(NuvlaBoxCommon.NuvlaBoxCommon):
 
         # self.api = nb.ss_api() if not api else api
         self.user_info = {}
+        # last retrieved NuvlaBox resource, and its ETag, for conditional GETs. See get_nuvlabox_info
+        self.nuvlabox_info = None
+        self.nuvlabox_info_etag = None
 
     def activation_is_possible(self):
         """ Checks for any hints of a previous activation
@@ -108,9 +110,35 @@ class Activate(NuvlaBoxCommon.NuvlaBoxCommon):
             self.commission_vpn()
 
     def get_nuvlabox_info(self):
-        """ Retrieves the respective resource from Nuvla """
+        """ Retrieves the respective resource from Nuvla
 
-        return self.api()._cimi_get(self.nuvlabox_id)
+        The request is conditional (If-None-Match), so if Nuvla says the resource hasn't changed, the previously
+        retrieved one is returned without downloading it again
+
+        :return: NuvlaBox resource
+        """
+
+        api = self.api()
+        session = getattr(api, 'session', None)
+        if session is None:
+            return api._cimi_get(self.nuvlabox_id)
+
+        headers = {'Accept': 'application/json'}
+        if self.nuvlabox_info and self.nuvlabox_info_etag:
+            headers['If-None-Match'] = self.nuvlabox_info_etag
+
+        response = session.get(f'{api.endpoint}/api/{self.nuvlabox_id}', headers=headers, allow_redirects=False)
+        if response.status_code == 304:
+            return self.nuvlabox_info
+
+        if response.status_code != 200:
+            # let the Nuvla client raise the respective error
+            return api._cimi_get(self.nuvlabox_id)
+
+        self.nuvlabox_info = response.json()
+        self.nuvlabox_info_etag = response.headers.get('ETag')
+
+        return self.nuvlabox_info
 
     def update_nuvlabox_resource(self):
         """ Updates the static information about the NuvlaBox
@@ -149,10 +177,9 @@ class Activate(NuvlaBoxCommon.NuvlaBoxCommon):
                     cpuinfo["Serial"] = l.split(":")[-1].replace(" ", "")
         return cpuinfo
 
-    @staticmethod
-    def get_os():
+    def get_os(self):
         """ Gets the host OS """
 
-        client = docker.from_env()
-        return "{} {}".format(client.info()["OperatingSystem"], client.info()["KernelVersion"])
+        info = self.docker_client.info()
+        return "{} {}".format(info["OperatingSystem"], info["KernelVersion"])
 
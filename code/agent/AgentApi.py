@@ -6,17 +6,22 @@
 List of functions to support the NuvlaBox Agent API instantiated by app.py
 """
 
-import json
 import logging
 import os
 import glob
+import fnmatch
 import socket
 import nuvla.api
 
 from agent.common import NuvlaBoxCommon
+from agent.common.NuvlaBoxCommon import json_dumps, json_loads
 
 nuvla_resource = "nuvlabox-peripheral"
 NB = NuvlaBoxCommon.NuvlaBoxCommon()
+context_file = f"{NB.data_volume}/{NB.context}"
+
+# parsed peripheral files, as {filepath: (st_mtime_ns, st_size, content)}
+peripherals_cache = {}
 
 
 def local_peripheral_exists(filepath):
@@ -26,10 +31,33 @@ def local_peripheral_exists(filepath):
     :returns boolean
     """
 
-    if os.path.exists(filepath):
-        return True
+    return os.path.lexists(filepath)
+
+
+def local_peripheral_read(filepath):
+    """ Reads and parses the local file copy of a peripheral (or any other JSON file in the shared volume). The parsed
+    content is cached and only re-read from disk when the file's modification time or size change
 
-    return False
+    :param filepath: path of the file in the .peripherals folder
+    :returns peripheral content. Raises FileNotFoundError if the file does not exist, or ValueError if malformed
+    """
+
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        peripherals_cache.pop(filepath, None)
+        raise
+
+    signature = (st.st_mtime_ns, st.st_size)
+    cached = peripherals_cache.get(filepath)
+    if cached and cached[:2] == signature:
+        return cached[2]
+
+    with open(filepath, 'rb') as f:
+        content = json_loads(f.read())
+
+    peripherals_cache[filepath] = (*signature, content)
+    return content
 
 
 def local_peripheral_save(filepath, content):
@@ -39,8 +67,11 @@ def local_peripheral_save(filepath, content):
     :param content: content of the file in JSON format
     """
 
-    with open(filepath, 'w') as f:
-        f.write(json.dumps(content))
+    with open(filepath, 'wb') as f:
+        f.write(json_dumps(content, as_bytes=True))
+
+    # the rewrite might keep the same size and modification time, so don't rely on those to notice it
+    peripherals_cache.pop(filepath, None)
 
 
 def local_peripheral_update(filepath, new_content):
@@ -50,13 +81,15 @@ def local_peripheral_update(filepath, new_content):
     :param new_content: updated content of the file in JSON format
     """
 
-    with open(filepath) as f:
-        peripheral = json.loads(f.read())
+    with open(filepath, 'rb') as f:
+        peripheral = json_loads(f.read())
 
     peripheral.update(new_content)
 
-    with open(filepath, 'w') as f:
-        f.write(json.dumps(peripheral))
+    with open(filepath, 'wb') as f:
+        f.write(json_dumps(peripheral, as_bytes=True))
+
+    peripherals_cache.pop(filepath, None)
 
 
 def local_peripheral_get_identifier(filepath):
@@ -67,8 +100,7 @@ def local_peripheral_get_identifier(filepath):
     """
 
     try:
-        with open(filepath) as f:
-            peripheral_nuvla_id = json.loads(f.read())["id"]
+        peripheral_nuvla_id = local_peripheral_read(filepath)["id"]
     except:
         # if something happens, just return None
         return None
@@ -94,7 +126,7 @@ def post(payload):
         logging.error("Payload {} is incomplete. Missing 'identifier'. {}".format(payload, e))
         return {"error": "Payload {} is incomplete. Missing 'identifier'. {}".format(payload, e)}, 400
 
-    peripheral_filepath = "{}/{}".format(NB.peripherals_dir, peripheral_identifier)
+    peripheral_filepath = f"{NB.peripherals_dir}/{peripheral_identifier}"
 
     # Check if peripheral already exists locally before pushing to Nuvla
     if local_peripheral_exists(peripheral_filepath):
@@ -106,9 +138,9 @@ def post(payload):
         payload['parent'] = NB.nuvlabox_id
 
     if 'version' not in payload:
-        if os.path.exists("{}/{}".format(NB.data_volume, NB.context)):
-            version = json.loads(open("{}/{}".format(NB.data_volume, NB.context)).read())['version']
-        else:
+        try:
+            version = local_peripheral_read(context_file)['version']
+        except FileNotFoundError:
             try:
                 tag = NB.docker_client.api.inspect_container(socket.gethostname())['Config']['Labels']['git.branch']
                 version = int(tag.split('.')[0])
@@ -180,7 +212,7 @@ def modify(peripheral_identifier, peripheral_nuvla_id=None, action='PUT', payloa
         logging.error(msg)
         return {"error": msg}, 405
 
-    peripheral_filepath = "{}/{}".format(NB.peripherals_dir, peripheral_identifier)
+    peripheral_filepath = f"{NB.peripherals_dir}/{peripheral_identifier}"
 
     if not local_peripheral_exists(peripheral_filepath):
         # local peripheral file does not exist, let's check in Nuvla
@@ -210,6 +242,7 @@ def modify(peripheral_identifier, peripheral_nuvla_id=None, action='PUT', payloa
                 if action == 'DELETE':
                     out_peripheral = NB.api().delete(peripheral_nuvla_id)
                     os.remove(peripheral_filepath)
+                    peripherals_cache.pop(peripheral_filepath, None)
                     logging.info("Deleted {} from Nuvla".format(peripheral_nuvla_id))
                 else:
                     out_peripheral = NB.api().edit(peripheral_nuvla_id, payload)
@@ -228,6 +261,7 @@ def modify(peripheral_identifier, peripheral_nuvla_id=None, action='PUT', payloa
                     if action == 'DELETE':
                         # Even if the peripheral does not exist in Nuvla anymore, let's delete it locally
                         os.remove(peripheral_filepath)
+                        peripherals_cache.pop(peripheral_filepath, None)
                         logging.info("Deleted {} from the NuvlaBox".format(peripheral_filepath))
                         return {"message": "Deleted %s" % peripheral_identifier}, 200
             except Exception as e:
@@ -236,6 +270,87 @@ def modify(peripheral_identifier, peripheral_nuvla_id=None, action='PUT', payloa
                 return {"error": "Error occurred while deleting {}: {}".format(peripheral_identifier, e)}, 500
 
 
+def split_identifier_pattern(pattern):
+    """ Splits an identifier pattern into its literal leading path and the remaining wildcard expression, so that
+    searches only need to descend into the literal part of the peripherals folder
+
+    :param pattern: glob-like identifier pattern, i.e. usb/vendor/1234/*
+    :returns (literal prefix, wildcard tail). The tail is empty if the pattern has no wildcards
+    """
+
+    parts = pattern.split('/')
+    for i, part in enumerate(parts):
+        if glob.has_magic(part):
+            return '/'.join(parts[:i]), '/'.join(parts[i:])
+
+    return pattern, ''
+
+
+def is_within_peripherals_dir(path):
+    """ Checks whether a path, once resolved, is inside the peripherals folder. Used to keep identifier patterns from
+    reaching other files in the NuvlaBox
+
+    :param path: path to check
+    :returns True if path is the peripherals folder or is within it
+    """
+
+    peripherals_root = os.path.realpath(NB.peripherals_dir)
+    real_path = os.path.realpath(path)
+
+    return real_path == peripherals_root or real_path.startswith(peripherals_root + os.sep)
+
+
+def scan_peripherals_dir(directory, recursive=False):
+    """ Lists the (non hidden) files in a directory with os.scandir, which, unlike glob, does not need an extra stat
+    per entry to tell files from folders
+
+    :param directory: folder to scan
+    :param recursive: whether to also scan all sub-folders
+    :returns generator of os.DirEntry
+    """
+
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir():
+                    if recursive:
+                        yield from scan_peripherals_dir(entry.path, recursive=True)
+                elif entry.is_file():
+                    yield entry
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+
+def iter_peripheral_files(search_root, tail):
+    """ Lazily lists all the peripheral files under search_root which match the wildcard expression tail
+
+    :param search_root: literal path where to start the search from
+    :param tail: wildcard expression, relative to search_root. If empty, search_root is the peripheral file itself
+    :returns generator of file paths
+    """
+
+    if not tail:
+        # no wildcards at all, so there's at most one file to look at
+        if os.path.isfile(search_root):
+            yield search_root
+    elif tail in ('**', '**/**', '**/*'):
+        for entry in scan_peripherals_dir(search_root, recursive=True):
+            yield entry.path
+    elif '/' not in tail and '**' not in tail and not tail.startswith('.'):
+        for entry in scan_peripherals_dir(search_root):
+            if fnmatch.fnmatchcase(entry.name, tail):
+                yield entry.path
+    else:
+        # multi-level expressions are left to glob
+        for filename in glob.iglob(os.path.join(search_root, tail), recursive=True):
+            # the expression might contain "..", so make sure glob didn't leave the peripherals folder
+            if not os.path.isdir(filename) and is_within_peripherals_dir(filename):
+                yield filename
+
+
 def find(parameter, value, identifier_pattern):
     """ Finds all locally registered peripherals that match parameter=value
 
@@ -247,25 +362,33 @@ def find(parameter, value, identifier_pattern):
 
     matched_peripherals = {}
 
-    search_dir = "{}/{}".format(NB.peripherals_dir, identifier_pattern) if identifier_pattern \
-        else NB.peripherals_dir + "/**/**"
-
-    for filename in glob.iglob(search_dir, recursive=True):
-        if os.path.isdir(filename):
+    # patterns are always relative to the peripherals folder, even if they start with /
+    prefix, tail = split_identifier_pattern((identifier_pattern or "").lstrip('/') or "**/**")
+    search_root = os.path.join(NB.peripherals_dir, prefix) if prefix else NB.peripherals_dir
+    if not is_within_peripherals_dir(search_root):
+        logging.warning(f'Identifier pattern {identifier_pattern} is outside the peripherals folder')
+        return matched_peripherals, 200
+
+    visited = set()
+    for filename in iter_peripheral_files(search_root, tail):
+        visited.add(filename)
+        try:
+            content = local_peripheral_read(filename)
+        except:
             continue
 
-        with open(filename) as f:
-            try:
-                content = json.loads(f.read())
-            except:
-                continue
-
         if parameter and value:
             if parameter in content and content[parameter] == value:
                 matched_peripherals[filename.replace(f'{NB.peripherals_dir}/', '')] = content
         else:
             matched_peripherals[filename.replace(f'{NB.peripherals_dir}/', '')] = content
 
+    if not identifier_pattern:
+        # this was a full sweep, so we can forget about the peripherals that are gone
+        # iterate over a snapshot, since the API threads can add entries to the cache meanwhile
+        for gone in [f for f in list(peripherals_cache) if f.startswith(NB.peripherals_dir) and f not in visited]:
+            peripherals_cache.pop(gone, None)
+
     return matched_peripherals, 200
 
 
@@ -276,14 +399,12 @@ def get(identifier):
     :returns peripheral content
     """
 
-    search_for = "{}/{}".format(NB.peripherals_dir, identifier)
+    search_for = f"{NB.peripherals_dir}/{identifier}"
 
-    if local_peripheral_exists(search_for):
-        with open(search_for) as p:
-            try:
-                return json.loads(p.read()), 200
-            except:
-                return {"error": "Cannot read peripheral information"}, 500
-    else:
+    try:
+        return local_peripheral_read(search_for), 200
+    except FileNotFoundError:
         return {"error": "Peripheral not found"}, 404
+    except:
+        return {"error": "Cannot read peripheral information"}, 500
 
@@ -43,9 +43,9 @@ class Infrastructure(NuvlaBoxCommon.NuvlaBoxCommon):
         """ Retrieve Swarm tokens """
 
         try:
-            if docker.from_env().swarm.attrs:
-                return docker.from_env().swarm.attrs['JoinTokens']['Manager'], \
-                       docker.from_env().swarm.attrs['JoinTokens']['Worker']
+            swarm_attrs = self.docker_client.swarm.attrs
+            if swarm_attrs:
+                return swarm_attrs['JoinTokens']['Manager'], swarm_attrs['JoinTokens']['Worker']
         except docker.errors.APIError as e:
             if self.lost_quorum_hint in str(e):
                 # quorum is lost
@@ -329,7 +329,7 @@ class Infrastructure(NuvlaBoxCommon.NuvlaBoxCommon):
         compute_api_url = f'https://{self.compute_api}:{self.compute_api_port}'
 
         try:
-            if docker.from_env().containers.get(self.compute_api).status != 'running':
+            if self.docker_client.containers.get(self.compute_api).status != 'running':
                 return False
             with NuvlaBoxCommon.timeout(3):
                 requests.get(compute_api_url)
@@ -519,9 +519,9 @@ class Infrastructure(NuvlaBoxCommon.NuvlaBoxCommon):
                 #     - IF the vpn-client is already running, then all is good, just save the VPN credential locally
                 logging.warning("VPN credential exists in Nuvla, but not locally")
 
-                dc = docker.from_env()
                 try:
-                    vpn_client_running = True if dc.containers.get("vpn-client").status == 'running' else False
+                    vpn_client_running = True if self.docker_client.containers.get("vpn-client").status == 'running' \
+                        else False
                 except docker.errors.NotFound as e:
                     vpn_client_running = False
                     logging.info("VPN client is not running")
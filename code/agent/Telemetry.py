@@ -9,6 +9,7 @@ resource in Nuvla.
 
 import datetime
 import docker
+import functools
 import logging
 import socket
 import json
@@ -16,12 +17,27 @@ import os
 import psutil
 import re
 import requests
+import time
+import threading
 import paho.mqtt.client as mqtt
 
 from agent.common import NuvlaBoxCommon
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from agent.common.NuvlaBoxCommon import json_dumps, json_loads
 from os import path, stat
+from requests.adapters import HTTPAdapter
 from subprocess import run, PIPE, STDOUT
-from pydoc import locate
+
+# optional attributes of a GPIO pin, with their types
+GPIO_PIN_ATTRIBUTES = (("bcm", int), ("name", str), ("mode", str), ("voltage", int))
+# each "gpio readall" line has two pins, i.e.
+#  |   4 |   7 | GPIO. 7 |   IN | 1 |  7 || 8  | 0 | IN   | TxD     | 15  | 14  |
+# with BCM | wPi | Name | Mode | V | Physical for the first one, and the same in reverse order for the second
+GPIO_READALL_LINE = re.compile(
+    r'\|\s*(?P<bcm>\d*)\s*\|\s*\d*\s*\|\s*(?P<name>[^|]*?)\s*\|\s*(?P<mode>[^|]*?)\s*\|'
+    r'\s*(?P<voltage>\d*)\s*\|\s*(?P<pin>\d+)\s*\|\|'
+    r'\s*(?P<pin_2>\d+)\s*\|\s*(?P<voltage_2>\d*)\s*\|\s*(?P<mode_2>[^|]*?)\s*\|\s*(?P<name_2>[^|]*?)\s*\|'
+    r'\s*\d*\s*\|\s*(?P<bcm_2>\d*)\s*\|')
 
 
 class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
@@ -42,8 +58,29 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         # self.api = nb.ss_api() if not api else api
         self.nb_status_id = nuvlabox_status_id
-        self.docker_client = docker.from_env()
         self.first_net_stats = {}
+        # these do not change during the lifetime of the agent
+        self.cpu_count = int(psutil.cpu_count())
+        self.last_boot = datetime.datetime.fromtimestamp(psutil.boot_time()).strftime(self.nuvla_timestamp_format)
+        # the Docker server version only changes when the daemon is restarted, so we only check it once in a while
+        self.docker_server_version = None
+        self.docker_server_version_checked_at = 0
+        self.time_between_get_docker_server_version = 300
+        # the deployment scenario is a label of this container, so it never changes
+        self.deployment_scenario = None
+        # last "docker info" output, which can be re-used by get_ip for time_between_get_docker_info seconds
+        self.docker_info = None
+        self.docker_info_checked_at = 0
+        self.time_between_get_docker_info = 30
+        # persistent HTTP(S) connections for the requests made on every telemetry cycle
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self.session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        # status updates are pushed to Nuvla in the background, one at a time, and their response is waited for
+        # up to this long (in seconds). Slower ones are collected in the next cycle. See update_status
+        self.status_update_pool = ThreadPoolExecutor(max_workers=1)
+        self.status_update = None
+        self.status_update_timeout = 10
         self.status = {'resources': None,
                        'status': None,
                        'status-notes': None,
@@ -71,6 +108,13 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
                        }
 
         self.mqtt_telemetry = mqtt.Client()
+        self.mqtt_telemetry.on_connect = self.on_mqtt_connect
+        self.mqtt_telemetry.on_disconnect = self.on_mqtt_disconnect
+        # set once the first connection to the broker is established. See start_mqtt_telemetry
+        self.mqtt_telemetry_connected = threading.Event()
+        self.mqtt_telemetry_connect_timeout = 3
+        self.mqtt_telemetry.reconnect_delay_set(min_delay=1, max_delay=self.mqtt_broker_keep_alive)
+        self.mqtt_telemetry_started = False
 
         self.gpio_utility = False
         try:
@@ -116,67 +160,92 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         # Default to 1 hour
         self.time_between_get_geolocation = 3600
 
+    def on_mqtt_connect(self, client, userdata, flags, rc):
+        """ Callback for when the connection to the MQTT broker is (re-)established
+
+        :param client: paho client instance
+        :param userdata: private user data (unused)
+        :param flags: response flags sent by the broker
+        :param rc: connection result code. 0 means success
+        """
+
+        if rc == 0:
+            self.mqtt_telemetry_connected.set()
+        else:
+            logging.warning(f'Connection to the NuvlaBox MQTT broker refused (rc={rc})')
+
+    @staticmethod
+    def on_mqtt_disconnect(client, userdata, rc):
+        """ Callback for when the connection to the MQTT broker is lost. The network loop started with loop_start()
+        automatically tries to reconnect, with backoff
+
+        :param client: paho client instance
+        :param userdata: private user data (unused)
+        :param rc: disconnection result code. 0 means the disconnect was requested
+        """
+
+        if rc != 0:
+            logging.warning(f'Lost connection to the NuvlaBox MQTT broker (rc={rc}). Reconnecting in the background...')
+
+    def start_mqtt_telemetry(self):
+        """ Connects to the NuvlaBox MQTT broker, asynchronously, and starts the paho network loop in the
+        background, so that the connection is kept alive (and re-established) between telemetry cycles
+
+        It waits a bit for the connection to be established, so that the first telemetry sample is not dropped
+        """
+
+        self.mqtt_telemetry.connect_async(self.mqtt_broker_host, self.mqtt_broker_port, self.mqtt_broker_keep_alive)
+        self.mqtt_telemetry.loop_start()
+        self.mqtt_telemetry_started = True
+
+        self.mqtt_telemetry_connected.wait(timeout=self.mqtt_telemetry_connect_timeout)
+
     def send_mqtt(self, nuvlabox_status, cpu=None, ram=None, disks=None, energy=None):
         """ Gets the telemetry data and send the stats into the MQTT broker
 
-        :param nuvlabox_status: full dump of the NB status {}
+        :param nuvlabox_status: full dump of the NB status, already JSON encoded
         :param cpu: tuple (capacity, load)
         :param ram: tuple (capacity, used)
         :param disk: list of {device: partition_name, capacity: value, used: value}
         :param energy: energy consumption metric
         """
 
-        try:
-            self.mqtt_telemetry.connect(self.mqtt_broker_host, self.mqtt_broker_port, self.mqtt_broker_keep_alive)
-        except ConnectionRefusedError:
-            logging.exception("Connection to NuvlaBox MQTT broker refused")
-            self.mqtt_telemetry.disconnect()
-            return
-        except socket.gaierror:
-            logging.exception("The NuvlaBox MQTT broker is not reachable...trying again later")
-            self.mqtt_telemetry.disconnect()
+        if not self.mqtt_telemetry_started:
+            self.start_mqtt_telemetry()
+
+        if not self.mqtt_telemetry.is_connected():
+            logging.warning("The NuvlaBox MQTT broker is not reachable...trying again later")
             return
 
-        os.system("mosquitto_pub -h {} -t {} -m '{}'".format(self.mqtt_broker_host,
-                                                             "nuvlabox-status",
-                                                             json.dumps(nuvlabox_status)))
+        msgs = [("nuvlabox-status", nuvlabox_status)]
 
         if cpu:
-            # e1 = self.mqtt_telemetry.publish("cpu/capacity", payload=str(cpu[0]))
-            # e2 = self.mqtt_telemetry.publish("cpu/load", payload=str(cpu[1]))
-            # ISSUE: for some reason, the connection is lost after publishing with paho-mqtt
-
-            # using os.system for now
-
-            os.system("mosquitto_pub -h {} -t {} -m '{}'".format(self.mqtt_broker_host,
-                                                                 "cpu",
-                                                                 json.dumps(cpu)))
+            msgs.append(("cpu", json_dumps(cpu)))
 
         if ram:
-            # self.mqtt_telemetry.publish("ram/capacity", payload=str(ram[0]))
-            # self.mqtt_telemetry.publish("ram/used", payload=str(ram[1]))
-            # same issue as above
-            os.system("mosquitto_pub -h {} -t {} -m '{}'".format(self.mqtt_broker_host,
-                                                                 "ram",
-                                                                 json.dumps(ram)))
+            msgs.append(("ram", json_dumps(ram)))
 
         if disks:
-            for dsk in disks:
-                # self.mqtt_telemetry.publish("disks", payload=json.dumps(dsk))
-                # same issue as above
-                os.system("mosquitto_pub -h {} -t {} -m '{}'".format(self.mqtt_broker_host,
-                                                                     "disks",
-                                                                     json.dumps(dsk)))
+            msgs += [("disks", json_dumps(dsk)) for dsk in disks]
 
         if energy:
-            # self.mqtt_telemetry.publish("ram/capacity", payload=str(ram[0]))
-            # self.mqtt_telemetry.publish("ram/used", payload=str(ram[1]))
-            # same issue as above
-            os.system("mosquitto_pub -h {} -t {} -m '{}'".format(self.mqtt_broker_host,
-                                                                 "energy",
-                                                                 json.dumps(energy)))
+            msgs.append(("energy", json_dumps(energy)))
+
+        for topic, payload in msgs:
+            # QoS 0: fire and forget, over the persistent connection
+            self.mqtt_telemetry.publish(topic, payload=payload)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def encode_raw_sample(sample_items):
+        """ JSON-encodes a resource sample. Disk and memory samples are mostly the same from one cycle to the next,
+        so the encoded string is cached
+
+        :param sample_items: tuple of the (key, value) pairs of the sample
+        :returns JSON string
+        """
 
-        # self.mqtt_telemetry.disconnect()
+        return json_dumps(dict(sample_items))
 
     def get_installation_parameters(self):
         """ Retrieves the configurations and parameteres used during the NuvlaBox Engine installation
@@ -239,11 +308,37 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
     def get_status(self):
         """ Gets several types of information to populate the NuvlaBox status """
 
-        # get status for Nuvla
-        disk_usage = self.get_disks_usage()
-        operational_status = self.get_operational_status()
-        operational_status_notes = self.get_operational_status_notes()
-        docker_info = self.get_docker_info()
+        # sample these only once per cycle
+        virtual_memory = psutil.virtual_memory()
+        root_disk_usage = psutil.disk_usage('/')
+        load_average = psutil.getloadavg()
+        cpu_stats = psutil.cpu_stats()
+
+        # the following collectors are mostly waiting on Docker, subprocesses, HTTP and sysfs, so run them
+        # concurrently. The slowest ones are submitted first
+        with ThreadPoolExecutor(max_workers=4) as collectors:
+            docker_info_future = collectors.submit(self.get_docker_info)
+            installation_params_future = collectors.submit(self.get_installation_parameters)
+            disk_usage_future = collectors.submit(self.get_disks_usage, root_disk_usage)
+            # chained on the Docker info of this cycle, so that get_ip doesn't have to ask Docker again
+            ip_future = collectors.submit(lambda: self.get_ip(docker_info_future.result()))
+            mgmt_api_future = collectors.submit(lambda: self.get_nuvlabox_api_endpoint(ip_future.result()))
+            docker_plugins_future = collectors.submit(self.get_docker_plugins)
+            net_stats_future = collectors.submit(self.get_network_info)
+
+            # get status for Nuvla
+            operational_status = self.get_operational_status()
+            operational_status_notes = self.get_operational_status_notes()
+            docker_server_version = self.get_docker_server_version()
+
+            docker_info = docker_info_future.result()
+            installation_params = installation_params_future.result()
+            disk_usage = disk_usage_future.result()
+            ip = ip_future.result()
+            mgmt_api = mgmt_api_future.result()
+            docker_plugins = docker_plugins_future.result()
+            net_stats = net_stats_future.result()
+
         swarm_node_id = docker_info.get("Swarm", {}).get("NodeID")
         cluster_id = docker_info.get('Swarm', {}).get('Cluster', {}).get('ID')
         remote_managers = docker_info.get('Swarm', {}).get('RemoteManagers')
@@ -252,30 +347,31 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
             cluster_managers = [rm.get('NodeID') for rm in remote_managers]
 
         cpu_sample = {
-            "capacity": int(psutil.cpu_count()),
-            "load": float(psutil.getloadavg()[2]),
-            "load-1": float(psutil.getloadavg()[0]),
-            "load-5": float(psutil.getloadavg()[1]),
-            "context-switches": int(psutil.cpu_stats().ctx_switches),
-            "interrupts": int(psutil.cpu_stats().interrupts),
-            "software-interrupts": int(psutil.cpu_stats().soft_interrupts),
-            "system-calls": int(psutil.cpu_stats().syscalls)
+            "capacity": self.cpu_count,
+            "load": float(load_average[2]),
+            "load-1": float(load_average[0]),
+            "load-5": float(load_average[1]),
+            "context-switches": int(cpu_stats.ctx_switches),
+            "interrupts": int(cpu_stats.interrupts),
+            "software-interrupts": int(cpu_stats.soft_interrupts),
+            "system-calls": int(cpu_stats.syscalls)
         }
 
         ram_sample = {
-            "capacity": int(round(psutil.virtual_memory()[0]/1024/1024)),
-            "used": int(round(psutil.virtual_memory()[3]/1024/1024))
+            "capacity": int(round(virtual_memory.total/1024/1024)),
+            "used": int(round(virtual_memory.used/1024/1024))
         }
 
-        cpu = {"topic": "cpu", "raw-sample": json.dumps(cpu_sample)}
+        # the CPU sample has ever-increasing counters, so there's no point in caching its encoding
+        cpu = {"topic": "cpu", "raw-sample": json_dumps(cpu_sample)}
         cpu.update(cpu_sample)
 
-        ram = {"topic": "ram", "raw-sample": json.dumps(ram_sample)}
+        ram = {"topic": "ram", "raw-sample": self.encode_raw_sample(tuple(ram_sample.items()))}
         ram.update(ram_sample)
 
         disks = []
         for dsk in disk_usage:
-            dsk.update({"topic": "disks", "raw-sample": json.dumps(dsk)})
+            dsk.update({"topic": "disks", "raw-sample": self.encode_raw_sample(tuple(dsk.items()))})
             disks.append(dsk)
 
         resources = {
@@ -290,15 +386,14 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
             'operating-system': docker_info["OperatingSystem"],
             "architecture": docker_info["Architecture"],
             "hostname": docker_info["Name"],
-            "ip": self.get_ip(),
-            "docker-server-version": self.docker_client.version()["Version"],
-            "last-boot": datetime.datetime.fromtimestamp(psutil.boot_time()).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "ip": ip,
+            "docker-server-version": docker_server_version,
+            "last-boot": self.last_boot,
             "status": operational_status,
             "status-notes": operational_status_notes,
-            "docker-plugins": self.get_docker_plugins()
+            "docker-plugins": docker_plugins
         }
 
-        mgmt_api = self.get_nuvlabox_api_endpoint()
         if mgmt_api:
             status_for_nuvla["nuvlabox-api-endpoint"] = mgmt_api
 
@@ -340,11 +435,9 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
             if swarm_node_id:
                 status_for_nuvla["cluster-node-role"] = "worker"
 
-        installation_params = self.get_installation_parameters()
         if installation_params:
             status_for_nuvla['installation-parameters'] = installation_params
 
-        net_stats = self.get_network_info()
         if net_stats:
             status_for_nuvla['resources']['net-stats'] = net_stats
 
@@ -398,22 +491,26 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         if self.nuvlabox_engine_version:
             status_for_nuvla['nuvlabox-engine-version'] = self.nuvlabox_engine_version
 
+        # encode the status only once, for both the Data Gateway and the internal monitoring
+        status_for_nuvla_json = json_dumps(status_for_nuvla, as_bytes=True)
+
         # Publish the telemetry into the Data Gateway
-        self.send_mqtt(status_for_nuvla, cpu_sample, ram_sample, disk_usage)
+        self.send_mqtt(status_for_nuvla_json, cpu_sample, ram_sample, disk_usage)
 
-        # get all status for internal monitoring
-        all_status = status_for_nuvla.copy()
-        all_status.update({
+        # get all status for internal monitoring, which is the status for Nuvla plus a few summary metrics.
+        # Instead of re-encoding the whole thing, merge the metrics into the already encoded JSON object
+        monitoring_metrics_json = json_dumps({
             "cpu-usage": psutil.cpu_percent(),
             "cpu-load": cpu_sample['load'],
-            "disk-usage": psutil.disk_usage("/")[3],
-            "memory-usage": psutil.virtual_memory()[2],
+            "disk-usage": root_disk_usage.percent,
+            "memory-usage": virtual_memory.percent,
             "cpus": cpu_sample['capacity'],
             "memory": ram_sample['capacity'],
-            "disk": int(psutil.disk_usage('/')[0]/1024/1024/1024)
-        })
+            "disk": int(root_disk_usage.total/1024/1024/1024)
+        }, as_bytes=True)
+        all_status_json = status_for_nuvla_json[:-1] + b',' + monitoring_metrics_json[1:]
 
-        return status_for_nuvla, all_status
+        return status_for_nuvla, all_status_json
 
     def get_power_consumption(self):
         """ Attempts to retrieve power monitoring information, if it exists. It is highly dependant on the
@@ -495,60 +592,28 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         """
 
         if os.path.exists(self.vulnerabilities_file):
-            with open(self.vulnerabilities_file) as vf:
-                return json.loads(vf.read())
+            with open(self.vulnerabilities_file, 'rb') as vf:
+                return json_loads(vf.read())
         else:
             return None
 
     @staticmethod
-    def parse_gpio_pin_cell(indexes, line):
-        """ Parses one cell of the output from gpio readall, which has 2 pins
+    def parse_gpio_pin(gpio_line_match, suffix=''):
+        """ Builds one of the 2 GPIO pins in a "gpio readall" line
 
-        :param indexes: the index numbers for the values of BCM, Name, Mode, V and Physical (in this order)
+        :param gpio_line_match: match of GPIO_READALL_LINE for the line
+        :param suffix: suffix of the regex groups for the pin. Empty for the first pin, '_2' for the second
 
         :returns a GPIO dict obj with the parsed pin"""
 
-        # the expected list of attributes is
-        expected = [{"position": None, "attribute": "BCM", "type": "int"},
-                    {"position": None, "attribute": "NAME", "type": "str"},
-                    {"position": None, "attribute": "MODE", "type": "str"},
-                    {"position": None, "attribute": "VOLTAGE", "type": "int"}]
-
-        needed_indexes_len = 5
-
-        if len(indexes) < needed_indexes_len:
-            logging.error(f"Missing indexes needed to parse GPIO pin: {indexes}. Need {needed_indexes_len}")
-            return None
-
-        gpio_values = line.split('|')
-        gpio_pin = {}
-        try:
-            gpio_pin['pin'] = int(gpio_values[indexes[-1]])
-            # if we can get the physical pin, we can move on. Pin is the only mandatory attr
+        # the physical pin is always there, and it is the only mandatory attribute
+        gpio_pin = {'pin': int(gpio_line_match.group(f'pin{suffix}'))}
+        for attribute, cast in GPIO_PIN_ATTRIBUTES:
+            value = gpio_line_match.group(f'{attribute}{suffix}')
+            if value:
+                gpio_pin[attribute] = cast(value)
 
-            for i, exp in enumerate(expected):
-                expected[i]["position"] = indexes[i]
-
-                try:
-                    value = locate(exp["type"])
-                    cast_value = value(gpio_values[exp["position"]].rstrip().lstrip())
-
-                    if cast_value or cast_value == 0:
-                        gpio_pin[exp["attribute"].lower()] = cast_value
-                    else:
-                        continue
-                except ValueError:
-                    logging.debug(f"No suitable {exp['attribute']} value for pin {gpio_pin['pin']}")
-                    continue
-
-            return gpio_pin
-        except ValueError:
-            logging.warning(f"Unable to get GPIO pin status on {gpio_values}, index {indexes[-1]}")
-            return None
-        except:
-            # if there's any other issue while doing so, it means the provided argument is not valid
-            logging.exception(f"Invalid list of indexes {indexes} for GPIO pin in {line}. Cannot parse this pin")
-            return None
+        return gpio_pin
 
     def get_gpio_pins(self):
         """ Uses the GPIO utility to scan and get the current status of all GPIO pins in the device.
@@ -566,18 +631,14 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         formatted_gpio_status = []
         for gpio_line in trimmed_gpio_out:
+            gpio_line_match = GPIO_READALL_LINE.search(gpio_line)
+            if not gpio_line_match:
+                logging.warning(f"Unable to get GPIO pin status from: {gpio_line}")
+                continue
 
             # each line has two columns = 2 pins
-
-            first_pin_indexes = [1, 3, 4, 5, 6]
-            second_pin_indexes = [14, 11, 10, 9, 8]
-            first_pin = self.parse_gpio_pin_cell(first_pin_indexes, gpio_line)
-            if first_pin:
-                formatted_gpio_status.append(first_pin)
-
-            second_pin = self.parse_gpio_pin_cell(second_pin_indexes, gpio_line)
-            if second_pin:
-                formatted_gpio_status.append(second_pin)
+            formatted_gpio_status.append(self.parse_gpio_pin(gpio_line_match))
+            formatted_gpio_status.append(self.parse_gpio_pin(gpio_line_match, suffix='_2'))
 
         return formatted_gpio_status
 
@@ -589,8 +650,8 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         now = int(datetime.datetime.timestamp(datetime.datetime.now()))
         try:
-            with open(self.ip_geolocation_file) as ipgeof:
-                previous_geolocation_json = json.loads(ipgeof.read())
+            with open(self.ip_geolocation_file, 'rb') as ipgeof:
+                previous_geolocation_json = json_loads(ipgeof.read())
 
             before = previous_geolocation_json["timestamp"]
 
@@ -608,7 +669,7 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         for service, service_info in self.ip_geolocation_services.items():
             try:
                 logging.debug("Inferring geolocation with 3rd party service %s" % service)
-                geolocation = requests.get(service_info['url'], allow_redirects=False).json()
+                geolocation = self.session.get(service_info['url'], allow_redirects=False, timeout=5).json()
             except:
                 logging.exception(f"Could not infer IP-based geolocation from service {service}")
                 continue
@@ -644,8 +705,8 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         if inferred_location:
             # we have valid coordinates, so let's keep a local record of it
             content = {"coordinated": inferred_location, "timestamp": now}
-            with open(self.ip_geolocation_file, 'w') as ipgeof:
-                ipgeof.write(json.dumps(content))
+            with open(self.ip_geolocation_file, 'wb') as ipgeof:
+                ipgeof.write(json_dumps(content, as_bytes=True))
 
         return inferred_location
 
@@ -669,7 +730,50 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         :returns JSON structure with all the Docker informations
         """
 
-        return self.docker_client.info()
+        self.docker_info = self.docker_client.info()
+        self.docker_info_checked_at = time.time()
+
+        return self.docker_info
+
+    def get_cached_docker_info(self):
+        """ Same as get_docker_info, but re-uses the last known Docker info if it is not older than
+        time_between_get_docker_info seconds
+
+        :returns JSON structure with all the Docker informations
+        """
+
+        if not self.docker_info or time.time() - self.docker_info_checked_at > self.time_between_get_docker_info:
+            return self.get_docker_info()
+
+        return self.docker_info
+
+    def get_docker_server_version(self):
+        """ Gets the Docker server version, which is cached for time_between_get_docker_server_version seconds
+
+        :returns Docker server version string
+        """
+
+        now = time.time()
+        if not self.docker_server_version or \
+                now - self.docker_server_version_checked_at > self.time_between_get_docker_server_version:
+            self.docker_server_version = self.docker_client.version()["Version"]
+            self.docker_server_version_checked_at = now
+
+        return self.docker_server_version
+
+    @staticmethod
+    def read_sysfs_int(filepath):
+        """ Reads a small sysfs file holding a single integer, with raw OS calls and without Python file objects
+
+        :param filepath: path to the sysfs file
+        :returns the integer value in the file
+        """
+
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            return int(os.read(fd, 32))
+        finally:
+            os.close(fd)
 
     def get_network_info(self):
         """ Gets the list of net ifaces and corresponding rxbytes and txbytes
@@ -680,26 +784,26 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         sysfs_net = "{}/sys/class/net".format(self.hostfs)
 
         try:
-            ifaces = os.listdir(sysfs_net)
+            with os.scandir(sysfs_net) as entries:
+                # the loopback traffic is internal to the device, so it is not reported
+                ifaces = [entry.name for entry in entries if entry.name != 'lo']
         except FileNotFoundError:
             logging.warning("Cannot find network information for this device")
             return {}
 
         previous_net_stats = {}
         try:
-            with open(self.previous_net_stats_file) as pns:
-                previous_net_stats = json.load(pns)
+            with open(self.previous_net_stats_file, 'rb') as pns:
+                previous_net_stats = json_loads(pns.read())
         except (FileNotFoundError, json.decoder.JSONDecodeError):
             pass
 
         net_stats = []
         for interface in ifaces:
-            stats = "{}/{}/statistics".format(sysfs_net, interface)
+            stats = f"{sysfs_net}/{interface}/statistics"
             try:
-                with open("{}/rx_bytes".format(stats)) as rx:
-                    rx_bytes = int(rx.read())
-                with open("{}/tx_bytes".format(stats)) as tx:
-                    tx_bytes = int(tx.read())
+                rx_bytes = self.read_sysfs_int(f"{stats}/rx_bytes")
+                tx_bytes = self.read_sysfs_int(f"{stats}/tx_bytes")
             except FileNotFoundError:
                 logging.warning("Cannot calculate net usage for interface {}".format(interface))
                 continue
@@ -756,19 +860,25 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
                 "bytes-received": rx_bytes_report
             })
 
-        with open(self.previous_net_stats_file, 'w') as pns:
-            pns.write(json.dumps(previous_net_stats))
+        with open(self.previous_net_stats_file, 'wb') as pns:
+            pns.write(json_dumps(previous_net_stats, as_bytes=True))
 
         return net_stats
 
     @staticmethod
-    def get_disks_usage():
-        """ Gets disk usage for N partitions """
+    def get_disks_usage(root_disk_usage=None):
+        """ Gets disk usage for N partitions
+
+        :param root_disk_usage: (optional) psutil.disk_usage('/') sample, to be used as fallback
+        """
+
+        if not root_disk_usage:
+            root_disk_usage = psutil.disk_usage('/')
 
         output = []
         output_fallback = [{'device': 'overlay',
-                            'capacity': int(psutil.disk_usage('/')[0]/1024/1024/1024),
-                            'used': int(psutil.disk_usage('/')[1]/1024/1024/1024)
+                            'capacity': int(root_disk_usage.total/1024/1024/1024),
+                            'used': int(root_disk_usage.used/1024/1024/1024)
                             }]
 
         lsblk_command = ["lsblk", "--json", "-o", "NAME,SIZE,MOUNTPOINT,FSUSED", "-b", "-a"]
@@ -777,7 +887,7 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
         if r.returncode != 0 or not r.stdout:
             return output_fallback
 
-        lsblk = json.loads(r.stdout)
+        lsblk = json_loads(r.stdout)
         for blockdevice, devices in lsblk.items():
             for parent_dev in devices:
                 flattened = [parent_dev]
@@ -815,28 +925,30 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         minimal_update = {}
         delete_attributes = []
-        for key in old_status.keys():
+        # attributes missing from the new status are only deleted if there was something set before
+        old_status_is_set = any(old_status.values())
+        for key, old_value in old_status.items():
             if key in new_status:
-                if new_status[key] is None:
-                    delete_attributes.append(key)
-                    continue
-                if old_status[key] != new_status[key]:
-                    minimal_update[key] = new_status[key]
-            else:
-                if any(old_status.values()):
+                new_value = new_status[key]
+                if new_value is None:
                     delete_attributes.append(key)
+                elif old_value != new_value:
+                    minimal_update[key] = new_value
+            elif old_status_is_set:
+                delete_attributes.append(key)
         return minimal_update, delete_attributes
 
-    def update_status(self):
-        """ Runs a cycle of the categorization, to update the NuvlaBox status """
+    def push_status(self, updated_status, delete_attributes, new_status, all_status_json):
+        """ Sends the status changes to Nuvla and, if successful, saves the whole status locally.
+        It runs in the background, in status_update_pool
+
+        :param updated_status: minimal set of status attributes to be updated in Nuvla
+        :param delete_attributes: list of status attributes to be removed from Nuvla
+        :param new_status: status for Nuvla, to be used as reference for the next diff
+        :param all_status_json: status for internal monitoring, JSON encoded
+        :returns Nuvla's response to the update
+        """
 
-        new_status, all_status = self.get_status()
-        updated_status, delete_attributes = self.diff(self.status, new_status)
-        updated_status['current-time'] = datetime.datetime.utcnow().isoformat().split('.')[0] + 'Z'
-        updated_status['id'] = self.nb_status_id
-        logging.info('Refresh status: %s' % updated_status)
-        if delete_attributes:
-            logging.info(f'Deleting the following attributes from NuvlaBox Status: {", ".join(delete_attributes)}')
         try:
             r = self.api().edit(self.nb_status_id,
                                 data=updated_status,
@@ -845,14 +957,66 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
             logging.exception("Unable to update NuvlaBox status in Nuvla")
             return {}
         else:
-            # write all status into the shared volume for the other components to re-use if necessary
-            with open(self.nuvlabox_status_file, 'w') as nbsf:
-                nbsf.write(json.dumps(all_status))
+            # write all status into the shared volume for the other components to re-use if necessary.
+            # Write and rename, so that readers never see a partially written file
+            tmp_status_file = f'{self.nuvlabox_status_file}.tmp'
+            with open(tmp_status_file, 'wb') as nbsf:
+                nbsf.write(all_status_json)
+            os.replace(tmp_status_file, self.nuvlabox_status_file)
 
         self.status.update(new_status)
 
         return r.data
 
+    def update_status(self):
+        """ Runs a cycle of the categorization, to update the NuvlaBox status.
+
+        The update is sent to Nuvla in the background, and its response is waited for only up to
+        status_update_timeout, so that a slow connection does not hold the telemetry cycle. A late response is
+        collected at the beginning of the next cycle, and if it is still not there by then, that cycle is skipped
+        (before doing any work), and its changes go out in the next diff.
+
+        :returns Nuvla's response to the status update, with the jobs of any late response from the previous cycle
+        """
+
+        late_response = {}
+        if self.status_update:
+            try:
+                late_response = self.status_update.result(timeout=self.status_update_timeout)
+            except FuturesTimeoutError:
+                logging.warning('Previous NuvlaBox status update is still in progress. Skipping this one')
+                return {}
+
+            self.status_update = None
+
+        new_status, all_status_json = self.get_status()
+
+        updated_status, delete_attributes = self.diff(self.status, new_status)
+        updated_status['current-time'] = datetime.datetime.utcnow().isoformat().split('.')[0] + 'Z'
+        updated_status['id'] = self.nb_status_id
+        logging.info('Refresh status: %s' % updated_status)
+        if delete_attributes:
+            logging.info(f'Deleting the following attributes from NuvlaBox Status: {", ".join(delete_attributes)}')
+
+        self.status_update = self.status_update_pool.submit(self.push_status,
+                                                            updated_status,
+                                                            delete_attributes,
+                                                            new_status,
+                                                            all_status_json)
+
+        try:
+            response = self.status_update.result(timeout=self.status_update_timeout)
+            self.status_update = None
+        except FuturesTimeoutError:
+            logging.warning('NuvlaBox status update is taking long. Its response will be handled in the next cycle')
+            response = {}
+
+        if isinstance(late_response.get('jobs'), list) and late_response['jobs']:
+            jobs = response.get('jobs') if isinstance(response.get('jobs'), list) else []
+            response = {**response, 'jobs': list(dict.fromkeys(late_response['jobs'] + jobs))}
+
+        return response
+
     def update_operational_status(self, status="RUNNING", status_log=None):
         """ Update the NuvlaBox status with the current operational status
 
@@ -869,20 +1033,21 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         self.set_local_operational_status(status)
 
-    def get_nuvlabox_api_endpoint(self):
+    def get_nuvlabox_api_endpoint(self, ip=None):
         """ Double checks that the NuvlaBox API is online
 
+        :param ip: (optional) the NuvlaBox IP, if already known. Otherwise it is inferred with get_ip
         :returns URL for the NuvlaBox API endpoint
         """
 
-        nb_ext_endpoint = "https://{}:5001/api".format(self.get_ip())
         nb_int_endpoint = "https://management-api:5001/api"
 
         try:
-            requests.get(nb_int_endpoint, verify=False)
+            # the management API is local, so if it doesn't answer quickly, it is not there
+            self.session.get(nb_int_endpoint, verify=False, timeout=2)
         except requests.exceptions.SSLError:
             # the API endpoint exists, we simply did not authenticate
-            return nb_ext_endpoint
+            return f"https://{ip if ip else self.get_ip()}:5001/api"
         except requests.exceptions.ConnectionError:
             return None
         except:
@@ -891,8 +1056,12 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         return nb_int_endpoint
 
-    def get_ip(self):
-        """ Discovers the NuvlaBox IP (aka endpoint) """
+    def get_ip(self, docker_info=None):
+        """ Discovers the NuvlaBox IP (aka endpoint)
+
+        :param docker_info: (optional) up to date Docker info. If not given, and if needed, the cached one is used.
+        See get_cached_docker_info
+        """
 
         # NOTE: This code does not work on Ubuntu 18.04.
         # with open("/proc/self/cgroup", 'r') as f:
@@ -900,9 +1069,11 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
 
         # Docker sets the hostname to be the short version of the container id.
         # This method of getting the container id works on both Ubuntu 16 and 18.
-        docker_id = socket.gethostname()
+        if not self.deployment_scenario:
+            docker_id = socket.gethostname()
+            self.deployment_scenario = self.docker_client.containers.get(docker_id).labels["nuvlabox.deployment"]
 
-        deployment_scenario = self.docker_client.containers.get(docker_id).labels["nuvlabox.deployment"]
+        deployment_scenario = self.deployment_scenario
 
         if deployment_scenario == "localhost":
             # Get the Docker IP within the shared Docker network
@@ -917,14 +1088,14 @@ class Telemetry(NuvlaBoxCommon.NuvlaBoxCommon):
             #       docker run --rm --net host alpine ip addr
 
             # FIXME: Review whether this is the correct impl. for this case.
-            ip = self.docker_client.info()["Swarm"]["NodeAddr"]
+            ip = (docker_info or self.get_cached_docker_info())["Swarm"]["NodeAddr"]
         elif deployment_scenario == "production":
             # Get either the public IP (via an online service) or use the VPN IP
 
             if path.exists(self.vpn_ip_file) and stat(self.vpn_ip_file).st_size != 0:
                 ip = str(open(self.vpn_ip_file).read().splitlines()[0])
             else:
-                ip = self.docker_client.info().get("Swarm", {}).get("NodeAddr")
+                ip = (docker_info or self.get_cached_docker_info()).get("Swarm", {}).get("NodeAddr")
                 if not ip:
                     # then probably this isn't running in Swarm mode
                     try:
@@ -21,8 +21,16 @@ import string
 import time
 from contextlib import contextmanager
 from nuvla.api import Api
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from subprocess import PIPE, Popen
 
+try:
+    import orjson
+except ImportError:
+    # orjson wheels are not available for all the architectures we run on
+    orjson = None
+
 
 def get_mac_address(ifname, separator=':'):
     """ Gets the MAC address for interface ifname """
@@ -75,6 +83,35 @@ def arguments():
     return parser
 
 
+def json_dumps(content, as_bytes=False):
+    """ Serializes content into JSON, with orjson if available and the standard json module otherwise
+
+    :param content: JSON serializable object
+    :param as_bytes: if True, returns the UTF-8 encoded document instead of a str
+    :return: JSON document
+    """
+
+    if orjson:
+        dumped = orjson.dumps(content)
+        return dumped if as_bytes else dumped.decode()
+
+    dumped = json.dumps(content)
+    return dumped.encode() if as_bytes else dumped
+
+
+def json_loads(raw):
+    """ Parses a JSON document, with orjson if available and the standard json module otherwise
+
+    :param raw: JSON document, as str or bytes
+    :return: parsed object. Raises json.decoder.JSONDecodeError (or a subclass of it) if malformed
+    """
+
+    if orjson:
+        return orjson.loads(raw)
+
+    return json.loads(raw)
+
+
 def raise_timeout(signum, frame):
     raise TimeoutError
 
@@ -96,15 +133,42 @@ def timeout(time):
         signal.signal(signal.SIGALRM, signal.SIG_IGN)
 
 
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter with separate connect and read timeouts
+
+    Requests that don't set their own (connect, read) timeout tuple get the adapter's one. nuvla-api, for example,
+    always sets a single 120s timeout, which would otherwise override socket.setdefaulttimeout
+    """
+
+    def __init__(self, *args, timeout=(3, 10), **kwargs):
+        """ Constructs the adapter
+
+        :param timeout: (connect, read) timeouts, in seconds
+        """
+
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if not isinstance(kwargs.get('timeout'), tuple):
+            kwargs['timeout'] = self.timeout
+
+        return super().send(request, **kwargs)
+
+
 class NuvlaBoxCommon():
     """ Common set of methods and variables for the NuvlaBox agent
     """
+    # single Docker client for all the agent classes. See docker_client
+    shared_docker_client = None
+    # single Nuvla API client (and HTTP connection pool) for all the agent classes. See api
+    shared_api = None
+
     def __init__(self, shared_data_volume="/srv/nuvlabox/shared"):
         """ Constructs an Infrastructure object, with a status placeholder
 
         :param shared_data_volume: shared Docker volume target path
         """
-        self.docker_client = docker.from_env()
         self.data_volume = shared_data_volume
         self.activation_flag = "{}/.activated".format(self.data_volume)
         self.swarm_manager_token_file = "swarm-manager-token"
@@ -243,11 +307,35 @@ class NuvlaBoxCommon():
             }
         }
 
+    @property
+    def docker_client(self):
+        """ Docker client, created on first use and shared by all instances """
+
+        if NuvlaBoxCommon.shared_docker_client is None:
+            NuvlaBoxCommon.shared_docker_client = docker.from_env()
+
+        return NuvlaBoxCommon.shared_docker_client
+
     def api(self):
-        """ Returns an Api object """
+        """ Returns the Api object, created on first use and shared by all instances
+
+        Reusing the same Api keeps its HTTP session, and thus the TLS connections to Nuvla, alive across cycles
+        """
+
+        if NuvlaBoxCommon.shared_api is None:
+            api = Api(endpoint='https://{}'.format(self.nuvla_endpoint),
+                      insecure=self.nuvla_endpoint_insecure, reauthenticate=True)
+
+            session = getattr(api, 'session', None)
+            if session is not None:
+                adapter = TimeoutHTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                             max_retries=Retry(total=2, backoff_factor=0.3),
+                                             timeout=(3, 10))
+                session.mount('https://', adapter)
+
+            NuvlaBoxCommon.shared_api = api
 
-        return Api(endpoint='https://{}'.format(self.nuvla_endpoint),
-                   insecure=self.nuvla_endpoint_insecure, reauthenticate=True)
+        return NuvlaBoxCommon.shared_api
 
     def push_event(self, data):
         """
@@ -17,11 +17,15 @@ Arguments:
 
 import socket
 import threading
-import json
+import multiprocessing
 import agent.AgentApi as AgentApi
 import time
-from flask import Flask, request, jsonify, Response
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FuturesTimeoutError
+from flask import Flask, request, Response
+from waitress import serve
 from agent.common import NuvlaBoxCommon
+from agent.common.NuvlaBoxCommon import json_dumps, json_loads
 from agent.Activate import Activate
 from agent.Telemetry import Telemetry
 from agent.Infrastructure import Infrastructure
@@ -35,6 +39,51 @@ app = Flask(__name__)
 data_volume = "/srv/nuvlabox/shared"
 default_log_filename = "agent.log"
 network_timeout = 10
+# the hostname of the container is its (short) Docker ID, and it doesn't change during the container's lifetime
+agent_container_id = socket.gethostname()
+
+# the data-gateway DNS resolution is cached, and refreshed in the background, so that API calls don't wait on it
+DNS_CACHE_TTL = 15
+DNS_CACHE_NEGATIVE_TTL = 1
+DNS_CACHE_REFRESH_INTERVAL = 10
+# name resolution can hang if the resolver is unavailable, so it runs in its own threads, with a deadline
+DNS_RESOLUTION_TIMEOUT = 2
+dns_resolver_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='dns-')
+# replaced as a whole on every resolution, so it can be read without locking
+data_gateway_dns = {"ts": 0, "ip": None, "error": None}
+# held while a resolution is in progress, so that there's only one at a time
+data_gateway_dns_lock = threading.Lock()
+
+# peripheral searches are cached for a short while, to absorb bursts of identical queries from other components.
+# Cleared whenever a peripheral is changed through the API
+PERIPHERAL_FIND_CACHE_TTL = 2
+PERIPHERAL_FIND_CACHE_MAX_SIZE = 256
+peripheral_find_cache = {}
+peripheral_find_cache_lock = threading.Lock()
+# single peripheral reads are cached until a peripheral is changed through the API. Each change bumps the generation,
+# so that reads which were already in progress don't put their (possibly outdated) result in the cache afterwards
+PERIPHERAL_GET_CACHE_MAX_SIZE = 512
+peripheral_get_cache = {}
+peripheral_get_cache_generation = 0
+peripheral_get_cache_lock = threading.Lock()
+
+# bodies of the static API responses, serialized only once
+healthcheck_response_body = json_dumps(True, as_bytes=True)
+data_gateway_found_response_body = json_dumps('success', as_bytes=True)
+
+# the API is served by multiple threads, but commissioning must happen one at a time
+commission_lock = threading.Lock()
+
+
+def json_response(content, status=200):
+    """ Builds a JSON response, like flask.jsonify, but serialized with orjson when available
+
+    :param content: JSON serializable object
+    :param status: HTTP status code
+    :return: Flask Response
+    """
+
+    return Response(json_dumps(content, as_bytes=True), status=status, mimetype='application/json')
 
 
 def init():
@@ -57,14 +106,61 @@ def set_status():
     if not value:
         logging.warning("Received status request with no value. Nothing to do")
     else:
-        logging.info("Setting NuvlaBox status to {}".format(value))
-        if log:
-            print(app.config["telemetry"], dir(app.config["telemetry"]))
+        logging.info("Setting NuvlaBox status to %s", value)
+        logging.debug("NuvlaBox status log: %s", log)
 
     logging.warning('to be implemented')
     return "to be implemented"
 
 
+def resolve_data_gateway():
+    """ Resolves the data-gateway hostname, and caches the result
+
+    If there's already a resolution in progress, it doesn't wait for it, and the cached result is returned instead.
+    Unless there's no result yet (i.e. right after startup), in which case it waits for the one in progress
+
+    :return: dict with the resolution timestamp, and either the IP or the resolution error
+    """
+
+    global data_gateway_dns
+
+    if not data_gateway_dns_lock.acquire(blocking=False):
+        if data_gateway_dns["ts"]:
+            return data_gateway_dns
+
+        if not data_gateway_dns_lock.acquire(timeout=DNS_RESOLUTION_TIMEOUT):
+            return {"ts": 0, "ip": None, "error": "data-gateway is still being resolved"}
+
+        if data_gateway_dns["ts"]:
+            # the resolution we waited for is done
+            data_gateway_dns_lock.release()
+            return data_gateway_dns
+
+    try:
+        resolution = dns_resolver_pool.submit(socket.getaddrinfo, 'data-gateway', None, socket.AF_INET)
+        try:
+            ip, error = resolution.result(timeout=DNS_RESOLUTION_TIMEOUT)[0][4][0], None
+        except socket.gaierror as e:
+            ip, error = None, str(e)
+        except FuturesTimeoutError:
+            # if the resolver hangs, don't let the pending resolutions pile up
+            resolution.cancel()
+            ip, error = None, f'Timed out resolving data-gateway after {DNS_RESOLUTION_TIMEOUT}s'
+
+        data_gateway_dns = {"ts": time.monotonic(), "ip": ip, "error": error}
+        return data_gateway_dns
+    finally:
+        data_gateway_dns_lock.release()
+
+
+def refresh_data_gateway_dns():
+    """ Keeps the data-gateway DNS cache warm. Meant to run in a background thread """
+
+    while True:
+        resolve_data_gateway()
+        time.sleep(DNS_CACHE_REFRESH_INTERVAL)
+
+
 @app.route('/api/find-data-gateway')
 def find_data_gateway():
     """
@@ -73,11 +169,14 @@ def find_data_gateway():
     :return: 200 or 404
     """
 
-    try:
-        socket.gethostbyname('data-gateway')
-        return jsonify('success'), 200
-    except socket.gaierror as e:
-        return jsonify(str(e)), 404
+    dns = data_gateway_dns
+    if time.monotonic() - dns["ts"] >= (DNS_CACHE_TTL if dns["ip"] else DNS_CACHE_NEGATIVE_TTL):
+        dns = resolve_data_gateway()
+
+    if dns["ip"]:
+        return Response(data_gateway_found_response_body, status=200, mimetype='application/json')
+
+    return json_response(dns["error"], 404)
 
 
 @app.route('/api/commission', methods=['POST'])
@@ -87,12 +186,13 @@ def trigger_commission():
     The request.data is the payload
     """
 
-    payload = json.loads(request.data)
+    payload = json_loads(request.data)
 
-    logging.info('Commission triggered via the NB Agent API with payload: %s ' % payload)
+    logging.info('Commission triggered via the NB Agent API with payload: %s ', payload)
 
-    commissioning_response = app.config["infra"].do_commission(payload)
-    return jsonify(commissioning_response)
+    with commission_lock:
+        commissioning_response = app.config["infra"].do_commission(payload)
+    return json_response(commissioning_response)
 
 
 @app.route('/api/healthcheck', methods=['GET'])
@@ -100,7 +200,7 @@ def healthcheck():
     """ Static endpoint just for clients to check if API/Agent is up and running
     """
 
-    return jsonify(True)
+    return Response(healthcheck_response_body, status=200, mimetype='application/json')
 
 
 @app.route('/api/agent-container-id', methods=['GET'])
@@ -108,7 +208,112 @@ def get_agent_container_id():
     """ Static endpoint just for clients to get the Agent container Docker ID
     """
 
-    return jsonify(socket.gethostname())
+    return json_response(agent_container_id)
+
+
+def find_peripherals(parameter, value, identifier_pattern):
+    """ Runs AgentApi.find, re-using a recent result for the same search, if any
+
+    :param parameter: peripheral parameter to filter by
+    :param value: value of the peripheral parameter to filter by
+    :param identifier_pattern: pattern for the peripheral identifiers
+    :return: message and return code
+    """
+
+    key = (parameter, value, identifier_pattern)
+    with peripheral_find_cache_lock:
+        cached = peripheral_find_cache.get(key)
+        if cached and time.monotonic() - cached[0] < PERIPHERAL_FIND_CACHE_TTL:
+            return cached[1], cached[2]
+
+    message, return_code = AgentApi.find(parameter, value, identifier_pattern)
+
+    if return_code == 200:
+        with peripheral_find_cache_lock:
+            if len(peripheral_find_cache) >= PERIPHERAL_FIND_CACHE_MAX_SIZE:
+                peripheral_find_cache.clear()
+            peripheral_find_cache[key] = (time.monotonic(), message, return_code)
+
+    return message, return_code
+
+
+def get_peripheral(identifier):
+    """ Runs AgentApi.get, re-using the result of previous calls for the same peripheral.
+    Peripherals are only changed through this API, so the cache is cleared on every change. See clear_peripheral_caches
+
+    :param identifier: local id of the peripheral
+    :return: message and return code
+    """
+
+    with peripheral_get_cache_lock:
+        cached = peripheral_get_cache.get(identifier)
+        if cached:
+            return cached
+
+        generation = peripheral_get_cache_generation
+
+    message, return_code = AgentApi.get(identifier)
+
+    # unexpected errors are not cached
+    if return_code in [200, 404]:
+        with peripheral_get_cache_lock:
+            if generation == peripheral_get_cache_generation:
+                if len(peripheral_get_cache) >= PERIPHERAL_GET_CACHE_MAX_SIZE:
+                    peripheral_get_cache.clear()
+                peripheral_get_cache[identifier] = (message, return_code)
+
+    return message, return_code
+
+
+def clear_peripheral_caches():
+    """ Forgets all the cached peripheral searches and reads """
+
+    global peripheral_get_cache_generation
+
+    with peripheral_find_cache_lock:
+        peripheral_find_cache.clear()
+
+    with peripheral_get_cache_lock:
+        peripheral_get_cache.clear()
+        peripheral_get_cache_generation += 1
+
+
+def dispatch_peripheral_request(method, identifier=None, payload=None, resource_id=None):
+    """ Runs a peripheral management action for a single peripheral
+
+    :param method: HTTP method of the action, i.e. POST, GET, PUT or DELETE
+    :param identifier: local id of the peripheral to be managed. Not needed for POST
+    :param payload: body of the action, for POST and PUT
+    :param resource_id: (optional) Nuvla ID of the peripheral, for PUT and DELETE
+    :return: message and return code
+    """
+
+    # reject incomplete payloads before doing any work for them
+    if method in ["POST", "PUT"] and not isinstance(payload, dict):
+        return {"error": "Payload malformed. It must be a JSON object"}, 400
+
+    if method == "POST" and not payload.get('identifier'):
+        return {"error": "Payload is incomplete. Missing 'identifier'"}, 400
+
+    if identifier:
+        logging.info('  ####   %s peripheral %s', method, identifier)
+        if method in ["DELETE", "PUT"]:
+            # DELETE accepts resource ID for simplicity and backward compatibility
+            try:
+                return AgentApi.modify(identifier, peripheral_nuvla_id=resource_id, action=method, payload=payload)
+            finally:
+                clear_peripheral_caches()
+        elif method == "GET":
+            return get_peripheral(identifier)
+    elif method == "POST":
+        logging.info('  ####   Creating new peripheral with payload %s', payload)
+        try:
+            return AgentApi.post(payload)
+        finally:
+            clear_peripheral_caches()
+
+    logging.info('  ####   Method %s not implemented yet!!', method)
+    return "Not implemented", 501
 
 
 @app.route('/api/peripheral', defaults={'identifier': None}, methods=['POST', 'GET'])
@@ -119,42 +324,108 @@ def manage_peripheral(identifier):
     :param identifier: local id of the peripheral to be managed
     """
 
-    logging.info('  ####   Received %s request for peripheral management' % request.method)
+    logging.info('  ####   Received %s request for peripheral management', request.method)
 
     payload = {}
     if request.data:
         try:
-            payload = json.loads(request.data)
-        except:
-            return jsonify({"error": "Payload {} malformed. It must be a JSON payload".format(payload)}), 400
-
-    if identifier:
-        logging.info('  ####   %s peripheral %s' % (request.method, identifier))
-        if request.method in ["DELETE", "PUT"]:
-            # DELETE accepts resource ID for simplicity and backward compatibility
-            resource_id = request.args.get('id')
-            message, return_code = AgentApi.modify(identifier, peripheral_nuvla_id=resource_id,
-                                                   action=request.method, payload=payload)
-        elif request.method == "GET":
-            message, return_code = AgentApi.get(identifier)
-        else:
-            logging.info('  ####   Method %s not implemented yet!!' % request.method)
-            message = "Not implemented"
-            return_code = 501
+            payload = json_loads(request.data)
+        except ValueError as e:
+            return json_response({"error": f"Payload malformed. It must be a JSON payload. {e}"}, 400)
+
+    if not identifier and request.method == "GET":
+        # FIND peripherals
+        parameter = request.args.get('parameter')
+        value = request.args.get('value')
+        identifier_pattern = request.args.get('identifier_pattern')
+        logging.info('  ####   Find peripherals with %s=%s', parameter, value)
+        message, return_code = find_peripherals(parameter, value, identifier_pattern)
     else:
-        # POST or FIND peripheral
-        if request.method == "POST":
-            logging.info('  ####   Creating new peripheral with payload %s' % payload)
-            message, return_code = AgentApi.post(payload)
-        else:
-            # GET
-            parameter = request.args.get('parameter')
-            value = request.args.get('value')
-            identifier_pattern = request.args.get('identifier_pattern')
-            logging.info('  ####   Find peripherals with {}={}'.format(parameter, value))
-            message, return_code = AgentApi.find(parameter, value, identifier_pattern)
+        message, return_code = dispatch_peripheral_request(request.method, identifier, payload,
+                                                           resource_id=request.args.get('id'))
+
+    return json_response(message, return_code)
+
+
+@app.route('/api/peripheral/batch', methods=['POST'])
+def manage_peripherals_batch():
+    """ API endpoint to let other components manage several NuvlaBox peripherals in one request
+
+    The request.data is a JSON list of actions, each being {"method": "POST|GET|PUT|DELETE", "identifier": ...,
+    "payload": {...}, "id": ...}, where "identifier", "payload" and "id" are as in /api/peripheral
+    """
+
+    try:
+        items = json_loads(request.data)
+    except:
+        return json_response({"error": "Payload malformed. It must be a JSON list"}, 400)
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return json_response({"error": "Payload malformed. It must be a JSON list of objects"}, 400)
+
+    logging.info('  ####   Received batch of %s peripheral management actions', len(items))
+
+    results = []
+    for item in items:
+        # a failing action must not hide the results of the ones before it, which have already been applied
+        try:
+            message, return_code = dispatch_peripheral_request(str(item.get('method', '')).upper(),
+                                                               identifier=item.get('identifier'),
+                                                               payload=item.get('payload', {}),
+                                                               resource_id=item.get('id'))
+        except Exception as e:
+            logging.exception('  ####   Peripheral management action %s failed', item)
+            message, return_code = {"error": str(e)}, 500
+
+        results.append({"return_code": return_code, "message": message})
+
+    return json_response(results, 207)
+
+
+def serve_api():
+    """ Serves the agent API. Meant to run in its own process, so that API calls and telemetry cycles don't compete
+    for the same GIL
+
+    The process is forked from the telemetry one, so app.config is inherited, but the Nuvla and Docker clients (and
+    their open connections) are not re-used. The new Nuvla client logs in with the NuvlaBox credentials, so that it
+    can re-authenticate by itself when the session expires
+    """
+
+    NuvlaBoxCommon.NuvlaBoxCommon.shared_api = None
+    NuvlaBoxCommon.NuvlaBoxCommon.shared_docker_client = None
+
+    infra = app.config["infra"]
+    try:
+        with open(infra.activation_flag, 'rb') as a:
+            user_info = json_loads(a.read())
+
+        infra.authenticate(infra.api(), user_info["api-key"], user_info["secret-key"])
+    except Exception as e:
+        # if only the login request failed, nuvla-api keeps the credentials and logs in again on the next 401/403
+        logging.error(f'Unable to authenticate the agent API with Nuvla: {str(e)}')
+
+    dns_refresh_thread = threading.Thread(target=refresh_data_gateway_dns, daemon=True)
+    dns_refresh_thread.start()
 
-    return jsonify(message), return_code
+    serve(app, host="0.0.0.0", port=80, threads=8, connection_limit=100)
+
+
+def launch_job(job_id, job_engine_lite_image):
+    """ Launches a pull-mode job in a Job Engine Lite container, unless it is already running
+
+    :param job_id: Nuvla ID of the job
+    :param job_engine_lite_image: Docker image for Job Engine lite
+    """
+
+    try:
+        job = Job(data_volume, job_id, job_engine_lite_image)
+        if job.do_nothing:
+            return
+
+        job.launch()
+    except Exception as ex:
+        # catch all
+        logging.error(f'Cannot process job {job_id}. Reason: {str(ex)}')
 
 
 if __name__ == "__main__":
@@ -167,12 +438,16 @@ if __name__ == "__main__":
     activation = Activate(data_volume)
     logging.info(f'Nuvla endpoint: {activation.nuvla_endpoint}')
     logging.info(f'Nuvla connection insecure: {str(activation.nuvla_endpoint_insecure)}')
+    # retry quickly at first, and then back off, to not hammer Nuvla during long outages. The jitter spreads out the
+    # retries of NuvlaBoxes that are all waiting for the same outage to end
+    activation_retry_delay = 0.5
     while True:
         can_activate, user_info = activation.activation_is_possible()
         if can_activate or user_info:
             break
 
-        e.wait(timeout=3)
+        e.wait(timeout=activation_retry_delay * random.uniform(0.8, 1.2))
+        activation_retry_delay = min(30, activation_retry_delay * 1.7)
 
     if not user_info:
         # this NuvlaBox hasn't been activated yet
@@ -187,49 +462,80 @@ if __name__ == "__main__":
 
     nuvlabox_info_updated_date = ''
     refresh_interval = 5
+    # while things are happening (new jobs, NuvlaBox resource changes), cycles are shortened down to this minimum,
+    # and then progressively relaxed back to the refresh interval
+    minimum_refresh_interval = 5
+    unchanged_cycles = 0
+    previous_cycle_signature = None
+    # the VPN credential is watched right away when the VPN server changes, and otherwise at most once per interval
+    vpn_credential_watch_interval = 60
+    last_watched_vpn_server_id = None
+    last_vpn_credential_watch = 0
+
+    # pull-mode jobs are launched concurrently, and launches can outlive a telemetry cycle
+    job_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='job-')
+    jobs_in_progress = {}
 
     app.config["telemetry"] = telemetry
     app.config["infra"] = infra
 
-    monitoring_thread = threading.Thread(target=app.run, kwargs={"host": "0.0.0.0", "port": "80"})
-    monitoring_thread.daemon = True
-    monitoring_thread.start()
+    api_process = multiprocessing.get_context('fork').Process(target=serve_api, name='agent-api', daemon=True)
+    api_process.start()
 
     # start telemetry
     logging.info("Starting telemetry...")
+
+    # bound once, so the loop below doesn't repeat the attribute lookups on every cycle
+    get_nuvlabox_info = activation.get_nuvlabox_info
+    watch_vpn_credential = infra.watch_vpn_credential
+    update_status = telemetry.update_status
+    try_commission = infra.try_commission
+    now = time.monotonic
+
     while True:
-        start_cycle = time.time()
-        nuvlabox_resource = activation.get_nuvlabox_info()
+        start_cycle = now()
+        nuvlabox_resource = get_nuvlabox_info()
         if nuvlabox_info_updated_date != nuvlabox_resource['updated']:
             refresh_interval = nuvlabox_resource['refresh-interval']
-            logging.warning('NuvlaBox resource updated. Refresh interval value: {}s'.format(refresh_interval))
+            logging.warning('NuvlaBox resource updated. Refresh interval value: %ss', refresh_interval)
             nuvlabox_info_updated_date = nuvlabox_resource['updated']
             activation.create_nb_document_file(nuvlabox_resource)
 
         # if there's a mention to the VPN server, then watch the VPN credential
-        if nuvlabox_resource.get("vpn-server-id"):
-            infra.watch_vpn_credential(nuvlabox_resource.get("vpn-server-id"))
+        vpn_server_id = nuvlabox_resource.get("vpn-server-id")
+        if vpn_server_id and (vpn_server_id != last_watched_vpn_server_id or
+                              start_cycle - last_vpn_credential_watch >= vpn_credential_watch_interval):
+            watch_vpn_credential(vpn_server_id)
+            last_watched_vpn_server_id = vpn_server_id
+            last_vpn_credential_watch = start_cycle
 
-        response = telemetry.update_status()
+        response = update_status()
 
         if isinstance(response.get('jobs'), list) and infra.job_engine_lite_image and response.get('jobs'):
             logging.info(f'Processing the following jobs in pull-mode: {response["jobs"]}')
+            jobs_in_progress = {job_id: launch for job_id, launch in jobs_in_progress.items() if not launch.done()}
             for job_id in response['jobs']:
-                job = Job(data_volume, job_id, infra.job_engine_lite_image)
-                if job.do_nothing:
-                    continue
+                if job_id not in jobs_in_progress:
+                    jobs_in_progress[job_id] = job_pool.submit(launch_job, job_id, infra.job_engine_lite_image)
 
-                try:
-                    job.launch()
-                except Exception as ex:
-                    # catch all
-                    logging.error(f'Cannot process job {job_id}. Reason: {str(ex)}')
+            # wait for the launches, but not beyond the refresh interval. Slow ones carry on in the background
+            _, pending_launches = wait(jobs_in_progress.values(), timeout=refresh_interval)
+            if pending_launches:
+                logging.warning(f'{len(pending_launches)} job(s) still being launched. Moving on...')
 
-        infra.try_commission()
+        try_commission()
+
+        cycle_signature = (nuvlabox_info_updated_date, tuple(response.get('jobs') or []))
+        if cycle_signature == previous_cycle_signature:
+            unchanged_cycles = min(unchanged_cycles + 1, 16)
+        else:
+            unchanged_cycles = 0
+        previous_cycle_signature = cycle_signature
+        effective_refresh_interval = min(refresh_interval, minimum_refresh_interval * 2 ** unchanged_cycles)
 
-        end_cycle = time.time()
+        end_cycle = now()
         cycle_duration = end_cycle - start_cycle
         # formula is R-2T, where
-        next_cycle_in = refresh_interval - 2 * cycle_duration
+        next_cycle_in = max(0.0, effective_refresh_interval - 2 * cycle_duration)
 
         e.wait(timeout=next_cycle_in)